@@ -1,68 +1,228 @@
-import io
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
 
 import fitz  # PyMuPDF
-from PIL import Image, ImageEnhance
+import numpy as np
+from PIL import Image
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import Optional
+from typing import Iterable, Iterator, Literal, Optional
 
 
 class PDFConversionConfig(BaseModel):
-    """Configuration model for PDF to PNG conversion."""
+    """Configuration model for PDF to image conversion."""
     input_pdf: str = Field(default="AR2024_C.pdf", description="Input PDF file path")
-    output_dir: str = Field(default="png_output", description="Output directory for PNG files")
-    contrast_factor: float = Field(default=2.0, ge=0.0, description="Contrast enhancement factor")
+    output_dir: str = Field(default="png_output", description="Output directory for page images")
+    image_format: Literal["webp", "png"] = Field(default="webp", description="Image format for saved pages")
+    contrast_factor: float = Field(default=1.0, ge=0.0, description="Contrast enhancement factor (1.0 leaves pages unchanged)")
     dpi: int = Field(default=300, gt=0, description="Resolution for rendering PDF pages")
+    adaptive_dpi: bool = Field(default=True, description="Pick the resolution per page based on its content")
+    text_dpi: int = Field(default=200, gt=0, description="Resolution for text-dominated pages when adaptive_dpi is enabled")
     grayscale: bool = Field(default=True, description="Convert to grayscale")
+    max_workers: Optional[int] = Field(default=None, gt=0, description="Number of render processes (defaults to min(CPU count, 8))")
 
 
-def convert_pdf_to_png(config: PDFConversionConfig) -> None:
+# Encoder settings per output format. Pages are only read by the OCR model,
+# so lossy WebP (much smaller than PNG) is the default; PNG uses a fast zlib
+# level since file size does not matter to the model.
+SAVE_OPTIONS = {
+    "webp": {"format": "WEBP", "quality": 80, "method": 4},
+    "png": {"format": "PNG", "compress_level": 1},
+}
+
+
+# PDF document opened once per worker process (fitz.Document cannot be pickled or shared)
+_worker_doc: Optional[fitz.Document] = None
+
+# Output buffer reused across pages rendered by the same worker process.
+# Only the contrast path (contrast_factor != 1.0) writes into it; the default
+# path wraps the pixmap samples directly and allocates per page as usual.
+_workspace: Optional[np.ndarray] = None
+
+
+def _init_worker(input_pdf: str) -> None:
+    """Open the PDF independently in each worker process."""
+    global _worker_doc
+    _worker_doc = fitz.open(input_pdf)
+
+
+def _get_workspace(size: int) -> np.ndarray:
+    """Return the worker's reusable output buffer, growing it if needed."""
+    global _workspace
+    if _workspace is None or _workspace.size < size:
+        _workspace = np.empty(size, dtype=np.uint8)
+    return _workspace
+
+
+def _page_dpi(page: fitz.Page, config: PDFConversionConfig) -> int:
     """
-    Convert PDF pages to individual PNG files in grayscale with increased contrast.
+    Choose the rendering resolution for a page from its content.
+    
+    Text-dominated pages render at text_dpi. Pages dominated by embedded
+    raster images render at up to dpi, capped at twice the highest embedded
+    image resolution; only pages without any text (pure scans) may go below
+    text_dpi.
     
     Args:
+        page: PDF page to inspect
         config: PDFConversionConfig instance with conversion settings
+    
+    Returns:
+        Resolution in DPI
+    """
+    if not config.adaptive_dpi:
+        return config.dpi
+    
+    # Area covered by text blocks (block type 0)
+    text_area = sum(
+        (x1 - x0) * (y1 - y0)
+        for x0, y0, x1, y1, _, _, block_type in page.get_text("blocks")
+        if block_type == 0
+    )
+    
+    # Area covered by embedded images and their effective resolution
+    image_area = 0.0
+    max_image_dpi = 0.0
+    for info in page.get_image_info():
+        x0, y0, x1, y1 = info["bbox"]
+        if x1 <= x0 or y1 <= y0:
+            continue
+        image_area += (x1 - x0) * (y1 - y0)
+        max_image_dpi = max(max_image_dpi, info["width"] * 72 / (x1 - x0))
+    
+    text_dpi = min(config.text_dpi, config.dpi)
+    if image_area <= text_area:
+        return text_dpi
+    
+    image_dpi = int(min(config.dpi, 2 * max_image_dpi))
+    if text_area > 0:
+        # Vector text over a low-resolution raster (background tint, watermark):
+        # the text still needs text_dpi, whatever the image resolution
+        return max(text_dpi, image_dpi)
+    
+    # Pure scan: no detail beyond twice the embedded image resolution
+    return max(1, image_dpi)
+
+
+def _render_one(args: tuple[int, PDFConversionConfig]) -> Path:
+    """
+    Render a single page of the worker's PDF and save it as an image.
+    
+    Args:
+        args: Tuple of (0-indexed page number, PDFConversionConfig)
+    
+    Returns:
+        Path of the saved image file
+    """
+    page_num, config = args
+    page = _worker_doc[page_num]
+    
+    # Render page to image (pixmap)
+    dpi = _page_dpi(page, config)
+    mat = fitz.Matrix(dpi / 72, dpi / 72)  # Scale factor for DPI
+    # Let PyMuPDF do the grayscale conversion while rendering, without alpha,
+    # so the samples already have the final pixel layout
+    colorspace = fitz.csGRAY if config.grayscale else fitz.csRGB
+    pix = page.get_pixmap(matrix=mat, colorspace=colorspace, alpha=False)
+    
+    if config.contrast_factor == 1.0:
+        # No contrast change requested: wrap the samples without another copy.
+        # pix.samples is a bytes copy owned by the image, unlike samples_mv,
+        # which must not outlive the pixmap.
+        mode = "L" if config.grayscale else "RGB"
+        img = Image.frombuffer(mode, (pix.width, pix.height), pix.samples, "raw", mode, 0, 1)
+    else:
+        # View pixmap samples as a numpy array (zero-copy, no PNG encode/decode)
+        shape = (pix.height, pix.width) if pix.n == 1 else (pix.height, pix.width, pix.n)
+        pixels = np.frombuffer(pix.samples_mv, dtype=np.uint8).reshape(shape)
+    
+        # Mean gray level, using the same luma weights as PIL's "L" conversion
+        if pixels.ndim == 2:
+            mean = int(round(pixels.mean()))
+        else:
+            mean = int(round(pixels.reshape(-1, pix.n).mean(axis=0) @ [0.299, 0.587, 0.114]))
+    
+        # Increase contrast with a single lookup-table pass (same blend against
+        # the mean gray level that ImageEnhance.Contrast performs), writing into
+        # the worker's reusable buffer
+        lut = np.clip((np.arange(256) - mean) * config.contrast_factor + mean, 0, 255).astype(np.uint8)
+        out = _get_workspace(pixels.size)[:pixels.size].reshape(shape)
+        np.take(lut, pixels, out=out)
+        # Release the view of samples_mv before the pixmap is collected
+        del pixels
+        img = Image.fromarray(out)
+    
+    # Save the image
+    output_filename = Path(config.output_dir) / f"page_{page_num + 1:04d}.{config.image_format}"
+    img.save(output_filename, **SAVE_OPTIONS[config.image_format])
+    return output_filename
+
+
+def get_page_count(input_pdf: str) -> int:
+    """Return the number of pages in the PDF file."""
+    pdf_path = Path(input_pdf)
+    if not pdf_path.exists():
+        raise FileNotFoundError(f"PDF file not found: {input_pdf}")
+    
+    with fitz.open(input_pdf) as doc:
+        return len(doc)
+
+
+def iter_pdf_pages(config: PDFConversionConfig, pages: Optional[Iterable[int]] = None) -> Iterator[tuple[int, Path]]:
+    """
+    Render PDF pages to image files, yielding each one as soon as it is saved.
+    
+    Args:
+        config: PDFConversionConfig instance with conversion settings
+        pages: 1-indexed page numbers to render (all pages if None); numbers
+            outside the document are ignored
+    
+    Yields:
+        Tuple of (1-indexed page number, path of the saved image file), in page order
     """
     # Create output directory if it doesn't exist
     output_path = Path(config.output_dir)
     output_path.mkdir(exist_ok=True)
     
-    # Open the PDF file
-    pdf_path = Path(config.input_pdf)
-    if not pdf_path.exists():
-        raise FileNotFoundError(f"PDF file not found: {config.input_pdf}")
-    
-    doc = fitz.open(config.input_pdf)
-    
-    print(f"Processing {len(doc)} pages from {config.input_pdf}")
-    
-    # Process each page
-    for page_num in range(len(doc)):
-        page = doc[page_num]
-        
-        # Render page to image (pixmap)
-        mat = fitz.Matrix(config.dpi / 72, config.dpi / 72)  # Scale factor for DPI
-        pix = page.get_pixmap(matrix=mat)
-        
-        # Convert pixmap to PIL Image
-        img_data = pix.tobytes("png")
-        img = Image.open(io.BytesIO(img_data))
-        
-        # Convert to grayscale if requested
-        if config.grayscale:
-            img = img.convert("L")
-        
-        # Increase contrast
-        enhancer = ImageEnhance.Contrast(img)
-        img = enhancer.enhance(config.contrast_factor)
-        
-        # Save the image
-        output_filename = output_path / f"page_{page_num + 1:04d}.png"
-        img.save(output_filename, "PNG")
-        print(f"Saved: {output_filename}")
-    
-    num_pages = len(doc)
-    doc.close()
+    num_pages = get_page_count(config.input_pdf)
+    if pages is None:
+        page_nums = list(range(1, num_pages + 1))
+    else:
+        page_nums = sorted({page_num for page_num in pages if 1 <= page_num <= num_pages})
+    
+    print(f"Processing {len(page_nums)} of {num_pages} pages from {config.input_pdf}")
+    
+    # Render pages in parallel; each worker opens the PDF itself since
+    # PyMuPDF holds the GIL and documents cannot be shared across processes.
+    # Workers are spawned rather than forked, since this may run from a
+    # background thread of a multi-threaded process (see pipeline.py).
+    max_workers = config.max_workers or min(os.cpu_count() or 1, 8)
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(config.input_pdf,),
+    ) as executor:
+        tasks = [(page_num - 1, config) for page_num in page_nums]
+        try:
+            for page_num, output_filename in zip(page_nums, executor.map(_render_one, tasks, chunksize=4)):
+                print(f"Saved: {output_filename}")
+                yield page_num, output_filename
+        except GeneratorExit:
+            # Consumer stopped early: drop pages that have not started rendering
+            executor.shutdown(cancel_futures=True)
+            raise
+
+
+def convert_pdf_to_png(config: PDFConversionConfig) -> None:
+    """
+    Convert PDF pages to individual image files (WebP by default) in grayscale, optionally with increased contrast.
+    
+    Args:
+        config: PDFConversionConfig instance with conversion settings
+    """
+    num_pages = sum(1 for _ in iter_pdf_pages(config))
     print(f"Conversion complete! {num_pages} pages processed.")
 
 
@@ -71,7 +231,7 @@ if __name__ == "__main__":
     config = PDFConversionConfig(
         input_pdf="AR2024_C.pdf",
         output_dir="png_output",
-        contrast_factor=2.0,
+        contrast_factor=1.0,
         dpi=300,
         grayscale=True
     )
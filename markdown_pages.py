@@ -0,0 +1,123 @@
+import mmap
+import os
+import pickle
+import re
+from pathlib import Path
+
+
+# Prefix of the note written in place of a page's text when OCR fails
+ERROR_NOTE_PREFIX = "*Error processing this page:"
+
+
+def file_version(path: str) -> tuple[int, int]:
+    """
+    Return (modification time in ns, size) identifying the file's contents,
+    or (0, 0) if it does not exist.
+    
+    The size catches rewrites that land within the filesystem's mtime
+    granularity.
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 0, 0
+    return stat.st_mtime_ns, stat.st_size
+
+
+def index_markdown_pages(markdown_path: str, version: tuple[int, int]):
+    """
+    Build an index of page markers (## Page XXXX) in the markdown file.
+    
+    The file is memory-mapped and scanned once for markers; no page text is
+    decoded. The index is persisted next to the file (<markdown_path>.idx)
+    and reused while the file's version (see file_version) is unchanged.
+    
+    Returns:
+        Tuple of (0-indexed page number -> (start, end) byte offsets, total page count)
+    """
+    if not Path(markdown_path).exists():
+        return {}, 0
+    
+    # Reuse the persisted index if it was built for this version of the file
+    index_path = Path(f"{markdown_path}.idx")
+    if index_path.exists():
+        try:
+            with open(index_path, 'rb') as f:
+                cached_version, offsets, total_pages = pickle.load(f)
+            if cached_version == version:
+                return offsets, total_pages
+        except Exception:
+            pass  # Corrupt or outdated index: rebuild it below
+    
+    offsets = {}
+    total_pages = 0
+    
+    with open(markdown_path, 'rb') as f:
+        # Version of the contents actually scanned, for the persisted index
+        stat = os.fstat(f.fileno())
+        scanned_version = (stat.st_mtime_ns, stat.st_size)
+        if stat.st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                size = len(mm)
+                # Each page runs from its marker to the next marker (or end of file)
+                matches = list(re.finditer(rb'(?m)^## Page (\d+)', mm))
+                for i, match in enumerate(matches):
+                    page_num = int(match.group(1)) - 1  # Convert to 0-indexed
+                    end_pos = matches[i + 1].start() if i + 1 < len(matches) else size
+                    offsets[page_num] = (match.start(), end_pos)
+                    total_pages = max(total_pages, page_num + 1)
+                
+                if not matches:
+                    # If no page markers, treat entire content as page 1
+                    offsets[0] = (0, size)
+                    total_pages = 1
+    
+    try:
+        with open(index_path, 'wb') as f:
+            pickle.dump((scanned_version, offsets, total_pages), f)
+    except OSError:
+        pass  # Index is only an optimization; keep going without persisting it
+    
+    return offsets, total_pages
+
+
+def read_markdown_page(markdown_path: str, start: int, end: int) -> str:
+    """Read a single page's markdown (including its page marker) from the file."""
+    with open(markdown_path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[start:end].decode('utf-8').strip()
+
+
+def read_completed_pages(markdown_path: str) -> dict[int, str]:
+    """
+    Read pages that already have extracted text from an existing OCR output file.
+    
+    Pages that are empty or only contain an error note are left out, so they
+    are processed again.
+    
+    Returns:
+        Mapping of 1-indexed page number to the page's extracted text
+    """
+    if not Path(markdown_path).exists():
+        return {}
+    
+    offsets, _ = index_markdown_pages(markdown_path, file_version(markdown_path))
+    completed = {}
+    
+    with open(markdown_path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            for page_num, (start, end) in offsets.items():
+                content = mm[start:end].decode('utf-8').strip()
+                if not content.startswith("## Page"):
+                    continue  # File without page markers
+                
+                # Drop the page marker line and the trailing separator
+                text = content.partition("\n")[2].strip()
+                text = text.removesuffix("---").strip()
+                
+                if text and not text.startswith(ERROR_NOTE_PREFIX):
+                    completed[page_num + 1] = text
+    
+    return completed
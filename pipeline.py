@@ -0,0 +1,158 @@
+import asyncio
+import sys
+import threading
+from pathlib import Path
+
+from main import PDFConversionConfig, get_page_count, iter_pdf_pages
+from text_extract_from_image import (
+    BATCH_SIZE,
+    CONCURRENCY,
+    append_batch,
+    create_vision_agent,
+    extract_batch,
+    init_environment,
+    load_resumable_pages,
+    write_output,
+)
+
+
+# Maximum number of rendered pages waiting for OCR
+QUEUE_SIZE = 16
+
+
+async def process_pdf(config: PDFConversionConfig, output_file: Path = Path("output.md"), resume: bool = True) -> None:
+    """
+    Render PDF pages and extract their text with the vision agent as a pipeline.
+    
+    Rendering runs in a background thread and hands finished pages to the OCR
+    stage through a bounded queue, so vision requests for earlier pages run
+    while later pages are still rendering. Each finished batch is appended to
+    output_file right away; the file is rewritten in page order at the end.
+    With resume, pages that already have text in output_file (written after
+    the PDF last changed) are kept and not sent again.
+    
+    Args:
+        config: PDFConversionConfig instance with conversion settings
+        output_file: Markdown file to write the extracted text to
+        resume: False to discard text from a previous run
+    """
+    if not Path(config.input_pdf).exists():
+        raise FileNotFoundError(f"PDF file not found: {config.input_pdf}")
+    
+    vision_agent = create_vision_agent()
+    
+    # Skip pages that already have text in the output file from a previous
+    # run, unless the PDF changed since
+    pdf_mtime = Path(config.input_pdf).stat().st_mtime
+    completed = load_resumable_pages(output_file, resume, lambda _: pdf_mtime)
+    
+    # Only render the pages that still need OCR
+    remaining = [
+        page_num
+        for page_num in range(1, get_page_count(config.input_pdf) + 1)
+        if page_num not in completed
+    ]
+    
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[tuple[int, Path] | None] = asyncio.Queue(maxsize=QUEUE_SIZE)
+    
+    # Set by the consumer when it stops reading, so the producer stops rendering
+    stop = threading.Event()
+    
+    def produce() -> None:
+        """Render pages and put them on the queue, followed by a None sentinel."""
+        pages = iter_pdf_pages(config, remaining)
+        try:
+            for item in pages:
+                if stop.is_set():
+                    break
+                asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+        finally:
+            pages.close()
+            # Nobody reads the sentinel once the consumer has stopped
+            if not stop.is_set():
+                asyncio.run_coroutine_threadsafe(queue.put(None), loop).result()
+    
+    # Bound the number of requests in flight to the model provider
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    
+    # Finished batches are appended here as they complete
+    f = open(output_file, "a", encoding="utf-8")
+    
+    async def run_batch(batch: list[tuple[int, Path]], warmup: asyncio.Task | None) -> dict[int, str] | Exception:
+        """Extract text from a batch once the warm-up batch is done and a request slot is free, and append it."""
+        if warmup is not None:
+            await asyncio.wait({warmup})
+        async with semaphore:
+            try:
+                result = await extract_batch(vision_agent, batch)
+            except Exception as e:
+                result = e
+        append_batch(f, batch, result)
+        return result
+    
+    producer = asyncio.create_task(asyncio.to_thread(produce))
+    
+    # Group rendered pages into batches and start OCR as soon as a batch is full.
+    # The first batch warms up the endpoint; later batches wait for it to finish.
+    batches = []
+    tasks = []
+    batch = []
+    
+    try:
+        while (item := await queue.get()) is not None:
+            batch.append(item)
+            if len(batch) == BATCH_SIZE:
+                batches.append(batch)
+                tasks.append(asyncio.create_task(run_batch(batch, tasks[0] if tasks else None)))
+                batch = []
+        
+        if batch:
+            batches.append(batch)
+            tasks.append(asyncio.create_task(run_batch(batch, tasks[0] if tasks else None)))
+        
+        batch_results = await asyncio.gather(*tasks)
+    finally:
+        # Stop the producer and unblock any pending put (at most one more item
+        # is added after draining), then wait for the render thread to exit
+        stop.set()
+        while not queue.empty():
+            queue.get_nowait()
+        await asyncio.wait({producer})
+        
+        # On error, stop batches still in flight before closing the output file
+        for task in tasks:
+            task.cancel()
+        f.close()
+    
+    processed_count = write_output(output_file, batches, batch_results, completed)
+    
+    print(f"\nProcessing complete! {processed_count} pages processed.")
+    print(f"Output saved to: {output_file}")
+    
+    # Surface rendering errors after writing whatever was processed
+    await producer
+
+
+def main():
+    """Main entry point for the script (pass --fresh to ignore a previous output.md)."""
+    # Create configuration with default values
+    config = PDFConversionConfig(
+        input_pdf="AR2024_C.pdf",
+        output_dir="png_output",
+        contrast_factor=1.0,
+        dpi=300,
+        grayscale=True
+    )
+    
+    init_environment()
+    try:
+        asyncio.run(process_pdf(config, resume="--fresh" not in sys.argv[1:]))
+    except FileNotFoundError as e:
+        print(f"Error: {e}")
+    except Exception as e:
+        print(f"An error occurred: {e}")
+
+
+if __name__ == "__main__":
+    main()
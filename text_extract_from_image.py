@@ -1,109 +1,359 @@
 import asyncio
+import re
+import sys
 from pathlib import Path
+from typing import Callable
 from PIL import Image
-from pydantic_ai import Agent, BinaryContent
+from pydantic import BaseModel, Field
+from pydantic_ai import Agent, BinaryContent, ModelRetry, RunContext
+from pydantic_ai.exceptions import ModelHTTPError
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential
 
 from langfuse import get_client
+from markdown_pages import ERROR_NOTE_PREFIX, read_completed_pages
 from dotenv import load_dotenv
-load_dotenv()
- 
-langfuse = get_client()
 
-# Verify langfuse connection
-if langfuse.auth_check():
-    print("Langfuse client is authenticated and ready!")
-    Agent.instrument_all()
-else:
-    print("Authentication failed. Please check your credentials and host.")
 
+# Maximum number of concurrent vision requests
+CONCURRENCY = 8
 
+# Number of page images sent in a single vision request
+BATCH_SIZE = 4
 
+# Media types of the page image formats written by main.py
+MEDIA_TYPES = {
+    ".webp": "image/webp",
+    ".png": "image/png",
+}
 
 
-async def process_png_files():
+# HTTP status codes from the model provider that are retried with backoff
+RETRY_STATUS_CODES = {429, 503}
+
+
+class PageText(BaseModel):
+    """Text extracted from a single page image."""
+    page_number: int = Field(description="Page number given in the label before the image")
+    markdown: str = Field(description="Extracted text of the page in markdown format")
+
+
+def init_environment() -> None:
     """
-    Read PNG files from png_output folder in order and extract text using PydanticAI vision agent.
-    Uses Pillow to open images and PydanticAI for text extraction.
-    Appends extracted text to output.md in markdown format.
+    Load settings from .env and enable Langfuse tracing of agent runs.
+    
+    Called from the entry points rather than at import time, so importing
+    this module (e.g. from spawned render workers) has no side effects.
     """
-    png_dir = Path("png_output")
-    output_file = Path("output.md")
+    load_dotenv()
     
-    if not png_dir.exists():
-        raise FileNotFoundError(f"Directory not found: {png_dir}")
+    langfuse = get_client()
     
-    # Create vision agent for text extraction
+    # Verify langfuse connection
+    if langfuse.auth_check():
+        print("Langfuse client is authenticated and ready!")
+        Agent.instrument_all()
+    else:
+        print("Authentication failed. Please check your credentials and host.")
+
+
+def create_vision_agent() -> Agent:
+    """
+    Create the PydanticAI vision agent used for text extraction.
+    
+    The full instruction lives in the (stable) system prompt so the provider
+    can cache it across calls; each request only carries the page labels and
+    images. The run's deps are the batch's page numbers, which the output
+    validator checks the response against.
+    """
     vision_agent = Agent(
         'openrouter:google/gemini-2.5-flash-lite',
-        system_prompt="Extract all text from the provided image. Return the extracted text in markdown format, preserving the structure and formatting as much as possible."
+        deps_type=list[int],
+        output_type=list[PageText],
+        system_prompt=(
+            "Extract all text from each provided page image and format it in markdown. "
+            "Preserve the structure, tables, and formatting as much as possible. "
+            "Each image is preceded by a 'Page N:' label. Return one entry per image "
+            "with that page number and the extracted markdown text."
+        ),
+        model_settings={'extra_body': {'cache_control': {'type': 'ephemeral'}}},
     )
     
-    # Clear or create output file
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write("# OCR Extracted Text\n\n")
+    @vision_agent.output_validator
+    def check_page_numbers(ctx: RunContext[list[int]], output: list[PageText]) -> list[PageText]:
+        """Ensure the response has exactly one entry per page label of the batch."""
+        expected = ctx.deps
+        if sorted(page.page_number for page in output) == sorted(expected):
+            return output
+        
+        if len(output) == len(expected):
+            # One entry per image but wrong numbers (e.g. the printed folio
+            # instead of the label, or repeats): entries follow image order
+            return [
+                PageText(page_number=page_num, markdown=page.markdown)
+                for page_num, page in zip(expected, output)
+            ]
+        
+        raise ModelRetry(
+            f"Return exactly one entry for each of the {len(expected)} images, "
+            f"with page numbers {expected} taken from the 'Page N:' labels."
+        )
+    
+    return vision_agent
+
+
+def find_page_images(png_dir: Path) -> list[tuple[int, Path]]:
+    """
+    Collect page images (page_NNNN.webp / .png) with one directory scan.
+    Other files matching page_* (e.g. "page_0001 (1).png") are ignored.
+    
+    Gaps in the numbering do not stop later pages from being found. If a page
+    exists in several formats, the most recently written one wins.
+    
+    Returns:
+        List of (page number, image path), ordered by page number
+    """
+    page_images = {}
+    candidates = [
+        (int(match.group(1)), p)
+        for p in png_dir.glob("page_*")
+        if p.suffix in MEDIA_TYPES and (match := re.fullmatch(r"page_(\d+)", p.stem))
+    ]
+    for page_num, png_file in sorted(candidates, key=lambda c: c[1].stat().st_mtime):
+        page_images[page_num] = png_file
+    return sorted(page_images.items())
+
+
+def _is_rate_limited(exc: BaseException) -> bool:
+    """Return True for provider errors that are worth retrying after a pause."""
+    return isinstance(exc, ModelHTTPError) and exc.status_code in RETRY_STATUS_CODES
+
+
+@retry(
+    retry=retry_if_exception(_is_rate_limited),
+    wait=wait_exponential(multiplier=1, max=30),
+    stop=stop_after_attempt(6),
+    reraise=True,
+)
+async def _run_agent(vision_agent: Agent, prompt: list, page_nums: list[int]):
+    """Run the vision agent, backing off exponentially on rate limiting."""
+    return await vision_agent.run(prompt, deps=page_nums)
+
+
+async def extract_batch(vision_agent: Agent, batch: list[tuple[int, Path]]) -> dict[int, str]:
+    """
+    Extract text from a batch of page images with a single vision request.
+    
+    Args:
+        vision_agent: Agent created by create_vision_agent
+        batch: List of (page number, image path)
+    
+    Returns:
+        Mapping of page number to extracted markdown text
+    """
+    prompt = []
+    
+    for page_num, png_file in batch:
+        print(f"Processing: {png_file}")
+        
+        # Open image using Pillow for validation
+        with Image.open(png_file) as img:
+            # Validate image can be opened and processed
+            img.load()
+        
+        # Read image bytes directly from file
+        image_data = png_file.read_bytes()
+        
+        # Label each image so the model can report its page number
+        prompt.append(f"Page {page_num}:")
+        prompt.append(BinaryContent(data=image_data, media_type=MEDIA_TYPES[png_file.suffix]))
+    
+    # Extract text using PydanticAI vision agent
+    result = await _run_agent(vision_agent, prompt, [page_num for page_num, _ in batch])
+    
+    # Map extracted text back to page numbers
+    return {page.page_number: page.markdown for page in result.output}
+
+
+def batch_pages(
+    batch: list[tuple[int, Path]],
+    batch_result: dict[int, str] | BaseException,
+) -> list[tuple[int, str | BaseException]]:
+    """
+    Pair each page of a batch with its extracted text, or the error that
+    prevented extraction (failed batch, or page missing from the response).
+    """
+    pages = []
+    for page_num, _ in batch:
+        if isinstance(batch_result, BaseException):
+            pages.append((page_num, batch_result))
+        elif page_num not in batch_result:
+            pages.append((page_num, ValueError("Page missing from model response")))
+        else:
+            pages.append((page_num, batch_result[page_num]))
+    return pages
+
+
+def _write_page(f, page_num: int, text: str | BaseException) -> None:
+    """Write one page section (marker, text or error note, separator)."""
+    f.write(f"## Page {page_num:04d}\n\n")
+    
+    if isinstance(text, BaseException):
+        # Write error note in place of the page text
+        f.write(f"{ERROR_NOTE_PREFIX} {str(text)}*\n\n")
+    else:
+        f.write(f"{text}\n\n")
+    
+    f.write("---\n\n")
+
+
+def append_batch(
+    f,
+    batch: list[tuple[int, Path]],
+    batch_result: dict[int, str] | BaseException,
+) -> None:
+    """
+    Append a finished batch to the open output file and flush it to disk,
+    so its pages survive a crash before the run completes.
     
-    # Process PNG files in order starting from page_0001.png
-    page_num = 1
+    Sections appended for a page replace earlier ones when the file is read
+    back (the last occurrence of a page marker wins).
+    """
+    for (page_num, text), (_, png_file) in zip(batch_pages(batch, batch_result), batch):
+        if isinstance(text, BaseException):
+            print(f"Error processing {png_file}: {text}")
+        _write_page(f, page_num, text)
+    
+    f.flush()
+
+
+def write_output(
+    output_file: Path,
+    batches: list[list[tuple[int, Path]]],
+    batch_results: list[dict[int, str] | BaseException],
+    completed: dict[int, str] | None = None,
+) -> int:
+    """
+    Write extracted text to the markdown file in page order.
+    
+    Pages of a failed batch, or pages missing from the model response, get an
+    error note instead of text. Pages in completed (text kept from a previous
+    run) are written alongside the newly extracted ones. This rewrites the
+    file as a whole, compacting the sections appended while batches finished.
+    
+    Returns:
+        Number of pages with text extracted in this run
+    """
+    # Page number -> extracted text, or the error that prevented extraction
+    pages: dict[int, str | BaseException] = dict(completed or {})
     processed_count = 0
     
-    while True:
-        png_file = png_dir / f"page_{page_num:04d}.png"
+    for batch, batch_result in zip(batches, batch_results):
+        for page_num, text in batch_pages(batch, batch_result):
+            pages[page_num] = text
+            if not isinstance(text, BaseException):
+                processed_count += 1
+    
+    # Write output.md in page order through a single file handle
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("# OCR Extracted Text\n\n")
         
-        if not png_file.exists():
-            break
+        for page_num, text in sorted(pages.items()):
+            _write_page(f, page_num, text)
+    
+    return processed_count
+
+
+def load_resumable_pages(output_file: Path, resume: bool, source_mtime: Callable[[int], float]) -> dict[int, str]:
+    """
+    Return pages of a previous run to keep, and rewrite output_file to hold
+    only those pages (just the header when starting fresh).
+    
+    Args:
+        output_file: Markdown file written by a previous run
+        resume: False to discard the previous run's text
+        source_mtime: Returns the modification time of a page's source (image
+            or PDF); a page is stale (and processed again) if its source
+            changed after output_file was last written
+    
+    Returns:
+        Mapping of page number to extracted text for pages to skip
+    """
+    completed = read_completed_pages(str(output_file)) if resume else {}
+    
+    if completed:
+        output_mtime = output_file.stat().st_mtime
+        completed = {
+            page_num: text
+            for page_num, text in completed.items()
+            if source_mtime(page_num) <= output_mtime
+        }
+    
+    write_output(output_file, [], [], completed)
+    print(f"Skipping {len(completed)} pages already in {output_file}")
+    return completed
+
+
+async def process_png_files(resume: bool = True):
+    """
+    Read page images (WebP or PNG) from png_output folder and extract text using PydanticAI vision agent.
+    Pages are sent in batches of BATCH_SIZE images per request. The first batch
+    runs alone to warm up the endpoint, then up to CONCURRENCY requests are in
+    flight; rate-limited requests are retried with exponential backoff.
+    Uses Pillow to open images and PydanticAI for text extraction.
+    Each finished batch is appended to output.md right away; the file is
+    rewritten in page order once all batches are done.
+    With resume, pages that already have text in output.md (and whose image
+    is older than output.md) are kept and not sent again.
+    """
+    png_dir = Path("png_output")
+    output_file = Path("output.md")
+    
+    if not png_dir.exists():
+        raise FileNotFoundError(f"Directory not found: {png_dir}")
+    
+    vision_agent = create_vision_agent()
+    page_images = find_page_images(png_dir)
+    
+    # Skip pages that already have text in output.md from a previous run,
+    # unless their image was re-rendered since
+    image_mtimes = {page_num: png_file.stat().st_mtime for page_num, png_file in page_images}
+    completed = load_resumable_pages(output_file, resume, lambda page_num: image_mtimes.get(page_num, 0.0))
+    png_files = [(page_num, png_file) for page_num, png_file in page_images if page_num not in completed]
+    
+    # Bound the number of requests in flight to the model provider
+    semaphore = asyncio.Semaphore(CONCURRENCY)
+    
+    with open(output_file, "a", encoding="utf-8") as f:
+        async def run_batch(batch: list[tuple[int, Path]]) -> dict[int, str] | Exception:
+            """Extract text from a batch, waiting for a free request slot, and append it."""
+            async with semaphore:
+                try:
+                    result = await extract_batch(vision_agent, batch)
+                except Exception as e:
+                    result = e
+            append_batch(f, batch, result)
+            return result
         
-        print(f"Processing: {png_file}")
+        # Split pages into batches
+        batches = [png_files[i:i + BATCH_SIZE] for i in range(0, len(png_files), BATCH_SIZE)]
         
-        try:
-            # Open image using Pillow for validation
-            with Image.open(png_file) as img:
-                # Validate image can be opened and processed
-                img.load()
-            
-            # Read image bytes directly from file
-            image_data = png_file.read_bytes()
-            
-            # Create BinaryContent for PydanticAI
-            binary_content = BinaryContent(data=image_data, media_type='image/png')
-            
-            # Extract text using PydanticAI vision agent
-            result = await vision_agent.run(
-                [
-                    "Extract all text from this image and format it in markdown. Preserve the structure, tables, and formatting as much as possible.",
-                    binary_content,
-                ]
-            )
-            
-            # Get extracted text from result
-            extracted_text = result.output if isinstance(result.output, str) else str(result.output)
-            
-            # Append to output.md with markdown formatting
-            with open(output_file, "a", encoding="utf-8") as f:
-                f.write(f"## Page {page_num:04d}\n\n")
-                f.write(f"{extracted_text}\n\n")
-                f.write("---\n\n")
-            
-            processed_count += 1
-            page_num += 1
-            
-        except Exception as e:
-            print(f"Error processing {png_file}: {e}")
-            # Append error note to output file
-            with open(output_file, "a", encoding="utf-8") as f:
-                f.write(f"## Page {page_num:04d}\n\n")
-                f.write(f"*Error processing this page: {str(e)}*\n\n")
-                f.write("---\n\n")
-            page_num += 1
-            continue
+        # Warm up the endpoint with the first batch alone, then run the remaining
+        # batches concurrently
+        batch_results = []
+        for group in (batches[:1], batches[1:]):
+            batch_results += await asyncio.gather(*(run_batch(batch) for batch in group))
+    
+    processed_count = write_output(output_file, batches, batch_results, completed)
     
     print(f"\nProcessing complete! {processed_count} pages processed.")
     print(f"Output saved to: {output_file}")
 
 
 def main():
-    """Main entry point for the script."""
+    """Main entry point for the script (pass --fresh to ignore a previous output.md)."""
+    init_environment()
     try:
-        asyncio.run(process_png_files())
+        asyncio.run(process_png_files(resume="--fresh" not in sys.argv[1:]))
     except FileNotFoundError as e:
         print(f"Error: {e}")
     except Exception as e:
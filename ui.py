@@ -1,143 +1,144 @@
 import streamlit as st
+from streamlit import runtime
 import fitz  # PyMuPDF
-from PIL import Image
 from pathlib import Path
-import io
 import sys
 import subprocess
 import os
-import re
+import threading
 
+import markdown_pages
 
-def load_pdf_pages(pdf_path: str):
-    """Load PDF and return total page count."""
-    doc = fitz.open(pdf_path)
-    return doc, len(doc)
 
+# Resolution and scale matrix for the PDF view, built once at import
+PDF_VIEW_DPI = 150
+PDF_VIEW_MATRIX = fitz.Matrix(PDF_VIEW_DPI / 72, PDF_VIEW_DPI / 72)
 
-def render_pdf_page(doc, page_num: int, dpi: int = 150):
-    """Render a specific PDF page as PIL Image."""
-    page = doc[page_num]
-    mat = fitz.Matrix(dpi / 72, dpi / 72)
-    pix = page.get_pixmap(matrix=mat)
-    img_data = pix.tobytes("png")
-    img = Image.open(io.BytesIO(img_data))
-    return img
 
-
-def parse_markdown_by_pages(markdown_path: str):
-    """Parse markdown file and split by page markers (## Page XXXX)."""
-    if not Path(markdown_path).exists():
-        return {}
-    
-    with open(markdown_path, 'r', encoding='utf-8') as f:
-        content = f.read()
+@st.cache_resource(show_spinner=False)
+def pdf_lock() -> threading.Lock:
+    """
+    Lock serializing access to the shared PDF document.
     
-    # Split by page markers: ## Page XXXX
-    # Pattern matches: ## Page followed by digits
-    pattern = r'## Page (\d+)'
-    pages = {}
-    
-    # Find all page markers
-    matches = list(re.finditer(pattern, content))
-    
-    if not matches:
-        # If no page markers, return entire content as page 1
-        pages[0] = content
-        return pages
+    Cached as a resource (rather than a module global, which Streamlit
+    recreates on every rerun) so all session threads use the same lock;
+    PyMuPDF is not thread-safe.
+    """
+    return threading.Lock()
+
+
+@st.cache_resource(max_entries=1, show_spinner=False)
+def load_pdf_pages(pdf_path: str, mtime: float):
+    """
+    Load PDF and return it with its total page count.
     
-    # Extract content for each page
-    for i, match in enumerate(matches):
-        page_num = int(match.group(1)) - 1  # Convert to 0-indexed
-        start_pos = match.start()
-        
-        # Find end position (start of next page or end of file)
-        if i + 1 < len(matches):
-            end_pos = matches[i + 1].start()
-        else:
-            end_pos = len(content)
-        
-        # Extract page content (including the page marker)
-        page_content = content[start_pos:end_pos].strip()
-        pages[page_num] = page_content
+    The document handle is shared across reruns and sessions and is only
+    reopened when the file's modification time changes; only the latest
+    handle is kept, so the one for an outdated file is released.
+    """
+    doc = fitz.open(pdf_path)
+    return doc, len(doc)
+
+
+@st.cache_data(max_entries=64, show_spinner=False)
+def render_pdf_page(pdf_path: str, page_num: int, mtime: float):
+    """
+    Render a specific PDF page at PDF_VIEW_DPI as JPEG bytes.
     
-    return pages
+    PyMuPDF encodes the JPEG directly and Streamlit sends the bytes as-is,
+    so no PIL round-trip or per-rerun re-encode is needed. Rendered pages
+    are cached (keyed by path, page and the PDF's modification time), so
+    revisiting a page skips rendering.
+    """
+    doc, _ = load_pdf_pages(pdf_path, mtime)
+    with pdf_lock():
+        page = doc[page_num]
+        pix = page.get_pixmap(matrix=PDF_VIEW_MATRIX)
+        return pix.tobytes("jpeg", jpg_quality=85)
 
 
-# Initialize session state
-if "page_index" not in st.session_state:
-    st.session_state.page_index = 0
+@st.cache_data(show_spinner=False)
+def index_markdown_pages(markdown_path: str, version: tuple[int, int]):
+    """Page index of the markdown file, cached until its version (mtime ns, size) changes."""
+    return markdown_pages.index_markdown_pages(markdown_path, version)
+
 
 # File paths
 PDF_PATH = "AR2024_C.pdf"
 MARKDOWN_PATH = "output.md"
 
-# Load PDF
-if not Path(PDF_PATH).exists():
-    st.error(f"PDF file not found: {PDF_PATH}")
-    st.stop()
 
-pdf_doc, pdf_total_pages = load_pdf_pages(PDF_PATH)
+def render_app():
+    """Render the side-by-side PDF and markdown viewer (runs on every Streamlit rerun)."""
+    # Initialize session state
+    if "page_index" not in st.session_state:
+        st.session_state.page_index = 0
+
+    # Load PDF
+    if not Path(PDF_PATH).exists():
+        st.error(f"PDF file not found: {PDF_PATH}")
+        st.stop()
 
-# Load markdown pages
-markdown_pages = parse_markdown_by_pages(MARKDOWN_PATH)
-markdown_total_pages = max(markdown_pages.keys()) + 1 if markdown_pages else 0
+    pdf_mtime = os.path.getmtime(PDF_PATH)
+    _, pdf_total_pages = load_pdf_pages(PDF_PATH, pdf_mtime)
 
-if markdown_total_pages == 0:
-    st.error(f"No markdown pages found in {MARKDOWN_PATH}")
-    st.stop()
+    # Load markdown pages
+    markdown_version = markdown_pages.file_version(MARKDOWN_PATH)
+    markdown_offsets, markdown_total_pages = index_markdown_pages(MARKDOWN_PATH, markdown_version)
 
-# Use minimum of both to ensure sync
-total_pages = min(pdf_total_pages, markdown_total_pages)
+    if markdown_total_pages == 0:
+        st.error(f"No markdown pages found in {MARKDOWN_PATH}")
+        st.stop()
 
-# Ensure page_index is within valid range
-if st.session_state.page_index >= total_pages:
-    st.session_state.page_index = total_pages - 1
-if st.session_state.page_index < 0:
-    st.session_state.page_index = 0
+    # Use minimum of both to ensure sync
+    total_pages = min(pdf_total_pages, markdown_total_pages)
 
-# Navigation buttons
-col1_btn, col2_btn, col3_btn = st.columns([1, 2, 1])
+    # Ensure page_index is within valid range
+    if st.session_state.page_index >= total_pages:
+        st.session_state.page_index = total_pages - 1
+    if st.session_state.page_index < 0:
+        st.session_state.page_index = 0
 
-with col1_btn:
-    if st.button("⬅️ Previous", disabled=(st.session_state.page_index == 0)):
-        st.session_state.page_index -= 1
-        st.rerun()
+    # Navigation buttons
+    col1_btn, col2_btn, col3_btn = st.columns([1, 2, 1])
 
-with col2_btn:
-    st.write(f"**Page {st.session_state.page_index + 1} of {total_pages}**")
+    with col1_btn:
+        if st.button("⬅️ Previous", disabled=(st.session_state.page_index == 0)):
+            st.session_state.page_index -= 1
+            st.rerun()
 
-with col3_btn:
-    if st.button("Next ➡️", disabled=(st.session_state.page_index >= total_pages - 1)):
-        st.session_state.page_index += 1
-        st.rerun()
+    with col2_btn:
+        st.write(f"**Page {st.session_state.page_index + 1} of {total_pages}**")
 
-st.divider()
+    with col3_btn:
+        if st.button("Next ➡️", disabled=(st.session_state.page_index >= total_pages - 1)):
+            st.session_state.page_index += 1
+            st.rerun()
 
-# Two-column layout for PDF and Markdown
-col_left, col_right = st.columns([1, 1])
+    st.divider()
 
-with col_left:
-    st.subheader("PDF View")
-    try:
-        pdf_img = render_pdf_page(pdf_doc, st.session_state.page_index)
-        st.image(pdf_img, use_container_width=True)
-    except Exception as e:
-        st.error(f"Error rendering PDF page: {e}")
+    # Two-column layout for PDF and Markdown
+    col_left, col_right = st.columns([1, 1])
 
-with col_right:
-    st.subheader("Markdown View")
-    try:
-        if st.session_state.page_index in markdown_pages:
-            markdown_content = markdown_pages[st.session_state.page_index]
-            st.markdown(markdown_content)
-        else:
-            st.warning(f"Markdown content not available for page {st.session_state.page_index + 1}")
-    except Exception as e:
-        st.error(f"Error loading markdown: {e}")
+    with col_left:
+        st.subheader("PDF View")
+        try:
+            pdf_img = render_pdf_page(PDF_PATH, st.session_state.page_index, pdf_mtime)
+            st.image(pdf_img, use_container_width=True)
+        except Exception as e:
+            st.error(f"Error rendering PDF page: {e}")
 
-# Close PDF document when done (though it will be reopened on rerun)
-# We keep it open for the session to avoid repeated file I/O
+    with col_right:
+        st.subheader("Markdown View")
+        try:
+            if st.session_state.page_index in markdown_offsets:
+                start, end = markdown_offsets[st.session_state.page_index]
+                markdown_content = markdown_pages.read_markdown_page(MARKDOWN_PATH, start, end)
+                st.markdown(markdown_content)
+            else:
+                st.warning(f"Markdown content not available for page {st.session_state.page_index + 1}")
+        except Exception as e:
+            st.error(f"Error loading markdown: {e}")
 
 
 def main():
@@ -145,14 +146,6 @@ def main():
     # Get the path to the current script
     script_path = os.path.abspath(__file__)
     
-    # Find streamlit executable
-    streamlit_cmd = "streamlit"
-    try:
-        import shutil
-        streamlit_cmd = shutil.which("streamlit") or "streamlit"
-    except:
-        pass
-    
     # Start Streamlit server on port 8080
     cmd = [
         sys.executable,
@@ -174,9 +167,9 @@ def main():
     subprocess.run(cmd)
 
 
-if __name__ == "__main__":
-    # Only start server if run directly (not when Streamlit imports this file)
-    # Check if streamlit is in the command line args (indicating we're already running)
-    if "streamlit" not in " ".join(sys.argv).lower():
-        main()
-
+if runtime.exists():
+    # Running inside Streamlit (every rerun re-executes this script)
+    render_app()
+elif __name__ == "__main__":
+    # Run directly with python: start the Streamlit server
+    main()